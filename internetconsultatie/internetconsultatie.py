@@ -3,175 +3,317 @@ of Dutch government online consultations
 """
 
 from pathlib import Path, PosixPath
+import multiprocessing as mp
+import os
 import re
+import sys
 import datetime
+import json
 import time
-import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import httpx
+import numpy as np
 import pandas as pd
-from nltk import ngrams
+import pypdfium2 as pdfium
 import textract
 import networkx as nx
-from bs4 import BeautifulSoup as bs
+from scipy import sparse
+import lxml.html
+from lxml import etree
 
 
 BASE = 'https://www.internetconsultatie.nl'
 SEP = '\n###\n'
 NR_RESP = r'Reacties op consultatie \[([0-9]+)\]'
+NR_RESP_LABEL = 'Reacties op consultatie ['
+NR_RESP_RE = re.compile(NR_RESP)
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 10
+NGRAM_PRIME = np.uint64(1099511628211)
+
+
+def create_session():
+    """Create http/2 client that reuses connections to the website"""
+    transport = httpx.HTTPTransport(
+        http2=True, retries=3,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+    )
+    return httpx.Client(
+        transport=transport, follow_redirects=True, timeout=30,
+        headers={'User-Agent': 'internetconsultatie'}
+    )
+
+
+SESSION = create_session()
+
+
+def has_class(name):
+    """Return xpath condition that element has class name"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+XP_NEXT = etree.XPath(f".//li[{has_class('next')}]")
+XP_RESULTS = etree.XPath(f"(.//div[{has_class('result--list')}])[1]//li")
+XP_ROWS = etree.XPath(
+    f"(.//table[{has_class('table__data-overview')}])[1]//tr"
+)
+XP_QS = etree.XPath('.//blockquote')
+XP_DOWNLOADS = etree.XPath(f".//a[{has_class('icon--download')}]")
+XP_SUBLABEL = etree.XPath(f".//span[{has_class('reacties__sublabel')}]")
 
 
 def get_url(item):
     """Extract href and return as full url"""
-    a = item.find('a')
-    if not a:
+    a = item.find('.//a')
+    if a is None:
         return None
     return f'{BASE}{a.get("href")}'
 
 
-def get_next_link(soup):
+def get_next_link(doc):
     """Extract link to next page, if exists"""
-    nxt = soup.find('li', class_='next')
+    nxt = XP_NEXT(doc)
     if nxt:
-        return get_url(nxt)
+        return get_url(nxt[0])
     return None
 
 
-def get_result_urls(soup):
+def get_result_urls(doc):
     """Extract links to individual responses"""
-    results_div = soup.find('div', class_='result--list')
-    results = results_div.find_all('li')
-    result_urls = [get_url(li) for li in results]
+    result_urls = [get_url(li) for li in XP_RESULTS(doc)]
     return [url for url in result_urls if url]
 
 
-def extract_kv(row):
-    """Try to extract key and value from row"""
-    try:
-        key = row.find('th').text.strip()
-    except AttributeError:
-        key = None
-    try:
-        value = row.find('td').text.strip()
-    except AttributeError:
-        value = None
-    return key, value
-
-
-def parse_table(table):
-    """Convert table to dict"""
-    kv = [extract_kv(row) for row in table.find_all('tr')]
-    data = {key:value for key, value in kv if key}
+def parse_table(doc):
+    """Convert data overview table to dict"""
+    data = {}
+    for row in XP_ROWS(doc):
+        th = row.find('.//th')
+        if th is None:
+            continue
+        key = th.text_content().strip()
+        if key:
+            td = row.find('.//td')
+            data[key] = td.text_content().strip() if td is not None else None
     return data
 
 
-def get_response(url, name, dir_attachments, download_attachments):
-    """Download and parse response"""
-    resp = requests.get(url)
+def get_response(url, name, dir_attachments, download_attachments,
+                 session=SESSION):
+    """Download and parse response, None if an attachment failed"""
+    resp = session.get(url)
     html = resp.text
-    soup = bs(html, 'lxml')
-    table = soup.find('table', class_='table__data-overview')
-    response = parse_table(table)
+    doc = lxml.html.fromstring(html)
+    response = parse_table(doc)
     if not name:
         response.pop('Naam', None)
     response['url'] = url
-    response['text'] = SEP.join([
-        question.text.strip() for question in soup.find_all('blockquote')
-    ])
+    response['text'] = SEP.join(
+        ''.join(question.itertext()).strip() for question in XP_QS(doc)
+    )
     if download_attachments:
-        response['attachment'] = download_files(soup, dir_attachments)
+        attachment = download_files(doc, dir_attachments, session=session)
+        if attachment is None:
+            return None
+        response['attachment'] = attachment
     return response
 
 
-def download_files(soup, dir_attachments):
-    """Download and save any attachments"""
+def download_files(doc, dir_attachments, session=SESSION):
+    """Download and save any attachments, None if a download failed"""
     download_ids = []
-    download_urls = [
-        f'{BASE}{a.get("href")}' for a
-        in soup.find_all('a', class_='icon--download')
-    ]
+    download_urls = [f'{BASE}{a.get("href")}' for a in XP_DOWNLOADS(doc)]
     for url in download_urls:
         download_id = url.split('/')[-2]
-        resp = requests.get(url, stream=True)
         path = dir_attachments / f'{download_id}.pdf'
-        with open(path, 'wb') as f:
-            f.write(resp.content)
+        try:
+            with session.stream('GET', url) as resp:
+                resp.raise_for_status()
+                with open(path, 'wb') as f:
+                    for chunk in resp.iter_bytes(CHUNK_SIZE):
+                        f.write(chunk)
+        except httpx.HTTPError as e:
+            print('Failed to download', url, e)
+            return None
         download_ids.append(download_id)
     return ','.join(download_ids)
 
 
+def read_cached_text(path):
+    """Return text previously extracted from attachment, if up to date"""
+    path_txt = path.with_suffix('.txt')
+    try:
+        if path_txt.stat().st_mtime >= path.stat().st_mtime:
+            return path_txt.read_text('utf-8')
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def extract_pdf_text(path):
+    """Extract text from pdf in process, using pdfium"""
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return '\n'.join(page.get_textpage().get_text_range() for page in pdf)
+    finally:
+        pdf.close()
+
+
+def extract_attachment(path):
+    """Extract text from attachment and cache it next to the attachment"""
+    try:
+        text_attachment = extract_pdf_text(path)
+    except Exception:
+        try:
+            text_attachment = textract.process(path).decode('utf8')
+        except Exception:
+            print('Failed to open', path.name)
+            return None
+    path.with_suffix('.txt').write_text(text_attachment, 'utf-8')
+    return text_attachment
+
+
+def can_fork():
+    """Check if worker processes can safely be started with fork"""
+    return (
+        'fork' in mp.get_all_start_methods()
+        and not sys.platform.startswith('darwin')
+    )
+
+
 def extract_text(df, dir_attachments):
     """Extract text from attachtments"""
     df = df.reset_index(drop=True)
-    df['text_attachment'] = None
-    for i, attachment_name in enumerate(df.attachment):
-        if pd.notna(attachment_name) and attachment_name != '':
-            path = dir_attachments / f'{int(attachment_name)}.pdf'
-            try:
-                text_attachment = textract.process(path).decode('utf8')
-            except TypeError:
-                text_attachment = None
-                print('Failed to open', path.name)
-            df.loc[i, 'text_attachment'] = text_attachment
+    paths = {
+        i: dir_attachments / f'{int(attachment_name)}.pdf'
+        for i, attachment_name in enumerate(df.attachment)
+        if pd.notna(attachment_name) and attachment_name != ''
+    }
+    texts = {i: read_cached_text(path) for i, path in paths.items()}
+    todo = [i for i, text in texts.items() if text is None]
+    todo_paths = [paths[i] for i in todo]
+    if len(todo) > 1 and can_fork():
+        # fork, so workers don't re-import the user's script, which may not
+        # have an if __name__ == '__main__' guard
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=mp.get_context('fork')
+        ) as executor:
+            extracted = list(executor.map(extract_attachment, todo_paths))
+    else:
+        extracted = [extract_attachment(path) for path in todo_paths]
+    texts.update(zip(todo, extracted))
+    text_attachment = [None] * len(df)
+    for i, text in texts.items():
+        text_attachment[i] = text
+    df['text_attachment'] = pd.array(text_attachment, dtype='string')
     return df
 
 
 def get_ngrams(text, text_attachment, n):
-    """Extract unique sentences from response"""
+    """Extract hashes of unique ngrams from response"""
     if pd.notna(text_attachment):
         txt = text_attachment
     else:
         txt = text
     if pd.isna(txt) or txt == '':
         return None
-    return set(ngrams(txt.split(), n))
-
-
-def jaccard_similarity(ngrams1, ngrams2):
-    """Calculate jaccard similarity"""
-    if not ngrams1 or not ngrams2:
-        return None
-    intersection = float(len(ngrams1.intersection(ngrams2)))
-    union = len(ngrams1.union(ngrams2))
-    if union == 0:
-        return None
-    return  intersection / union
+    tokens = txt.split()
+    token_hashes = np.fromiter(
+        (hash(token) for token in tokens), dtype=np.int64, count=len(tokens)
+    ).view(np.uint64)
+    nr_ngrams = max(len(tokens) - n + 1, 0)
+    hashes = np.zeros(nr_ngrams, dtype=np.uint64)
+    for i in range(n):
+        hashes = (hashes * NGRAM_PRIME) ^ token_hashes[i:i + nr_ngrams]
+    return np.unique(hashes.view(np.int64))
+
+
+def get_similar_pairs(n_grams, threshold):
+    """Find pairs of docs with jaccard similarity of at least threshold"""
+    sizes = np.array([0 if g is None else g.size for g in n_grams])
+    if not sizes.sum():
+        return []
+    indptr = np.concatenate(([0], np.cumsum(sizes)))
+    all_hashes = np.concatenate([g for g in n_grams if g is not None])
+    vocab, indices = np.unique(all_hashes, return_inverse=True)
+    # binary doc x ngram matrix; its product with its transpose contains the
+    # intersection sizes of all pairs of docs
+    data = np.ones(len(indices), dtype=np.int32)
+    matrix = sparse.csr_matrix(
+        (data, indices, indptr), shape=(len(n_grams), len(vocab))
+    )
+    intersections = sparse.triu(matrix @ matrix.T, k=1).tocoo()
+    rows, cols = intersections.row, intersections.col
+    unions = sizes[rows] + sizes[cols] - intersections.data
+    similarities = intersections.data / unions
+    mask = (similarities > 0) & (similarities >= threshold)
+    return list(zip(rows[mask].tolist(), cols[mask].tolist()))
 
 
 def add_components(df, n=5, threshold=0.3, dir_attachments='../data/attachments'):
     """Find clusters of similar docs"""
-    df = df.reset_index(drop=True)
-    df['component'] = None
     if not isinstance(dir_attachments, PosixPath):
         dir_attachments = Path(dir_attachments)
     if 'text_attachment' not in df.columns:
         df = extract_text(df, dir_attachments)
+    else:
+        df = df.reset_index(drop=True)
     n_grams = [
         get_ngrams(text, text_attachment, n)
         for text, text_attachment
-        in zip(df.text, df.text_attachment)
+        in df[['text', 'text_attachment']].itertuples(index=False, name=None)
     ]
-    edges = []
-    for i, n_gram1 in enumerate(n_grams):
-        for j, n_gram2 in enumerate(n_grams):
-            if not j > i:
-                continue
-            similarity = jaccard_similarity(n_gram1, n_gram2)
-            if not similarity:
-                continue
-            if similarity >= threshold:
-                edges.append((i, j))
+    edges = get_similar_pairs(n_grams, threshold)
     G = nx.Graph()
     G.add_edges_from(edges)
+    components = np.full(len(df), np.nan)
     for i, component in enumerate(nx.connected_components(G)):
-        for j in component:
-            df.loc[j, 'component'] = i
+        components[list(component)] = i
+    df['component'] = pd.array(components, dtype='Int64')
     return df
 
 
+def load_checkpoint(path_checkpoint, path_excel):
+    """Load results saved by a previous run"""
+    if path_checkpoint.exists():
+        lines = path_checkpoint.read_text('utf-8').splitlines()
+        results = []
+        for nr, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                if nr < len(lines) - 1:
+                    raise
+                # last line was cut off when a previous run was interrupted
+                path_checkpoint.write_text(
+                    ''.join(f'{kept}\n' for kept in lines[:nr]), 'utf-8'
+                )
+        return results
+    df = pd.read_excel(path_excel)
+    with open(path_checkpoint, 'w', encoding='utf-8') as f:
+        lines = df.to_json(orient='records', lines=True, force_ascii=False)
+        f.write(lines.rstrip('\n') + '\n')
+    return df.to_dict('records')
+
+
+def save_checkpoint(path_checkpoint, results):
+    """Append new results to checkpoint file"""
+    if not results:
+        return
+    lines = [json.dumps(result, ensure_ascii=False) for result in results]
+    with open(path_checkpoint, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
 def download_responses(consultation, name=False, dir_responses='../data',
                        download_attachments=True,
                        dir_attachments='../data/attachments',
                        extract_text_attachment=True, components=True, n=5,
-                       threshold=0.3):
+                       threshold=0.3, session=SESSION,
+                       max_workers=MAX_WORKERS):
     """Download responses to consultation
 
     :param consultation: name of the consultation, taken from its url
@@ -186,6 +328,8 @@ def download_responses(consultation, name=False, dir_responses='../data',
     :param n: n to be used to extract ngrams (if add_components is set)
     :param threshold: threshold value to determine if texts are similar, based
         on jaccard similarity of ngrams (if add_components is set)
+    :param session: httpx client used to download pages
+    :param max_workers: number of responses downloaded concurrently
     """
     if not isinstance(dir_responses, PosixPath):
         dir_responses = Path(dir_responses)
@@ -195,33 +339,41 @@ def download_responses(consultation, name=False, dir_responses='../data',
     dir_attachments.mkdir(exist_ok=True)
     filename = f'responses_{consultation}.xlsx'
     path_responses = dir_responses / filename
+    path_checkpoint = path_responses.with_suffix('.jsonl')
     try:
-        df = pd.read_excel(path_responses)
-        done = list(df.url)
-        responses = [dict(row) for _, row in df.iterrows()]
+        responses = load_checkpoint(path_checkpoint, path_responses)
+        done = {result['url'] for result in responses}
     except FileNotFoundError:
-        done = []
+        done = set()
         responses = []
+    fetch = partial(
+        get_response, name=name, dir_attachments=dir_attachments,
+        download_attachments=download_attachments, session=session
+    )
     nxt = f'{BASE}/{consultation}/reacties/datum/'
     i = 0
-    while nxt:
-        if i % 10 == 0 and responses:
-            df = pd.DataFrame(responses)
-            df.to_excel(path_responses, index=False)
-            print(i, datetime.datetime.now().strftime('%H:%M:%S'))
-
-        resp = requests.get(nxt)
-        html = resp.text
-        soup_results = bs(html, 'lxml')
-        result_urls = get_result_urls(soup_results)
-        responses.extend([
-            get_response(url, name, dir_attachments, download_attachments)
-            for url in result_urls
-            if url not in done
-        ])
-        nxt = get_next_link(soup_results)
-        i += 1
-        time.sleep(1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while nxt:
+            if i % 10 == 0 and responses:
+                print(i, datetime.datetime.now().strftime('%H:%M:%S'))
+
+            resp = session.get(nxt)
+            html = resp.text
+            doc_results = lxml.html.fromstring(html)
+            result_urls = get_result_urls(doc_results)
+            # responses with failed attachments are left out, so that they
+            # are retried on the next run
+            new_responses = [
+                response for response in executor.map(
+                    fetch, [url for url in result_urls if url not in done]
+                )
+                if response is not None
+            ]
+            save_checkpoint(path_checkpoint, new_responses)
+            responses.extend(new_responses)
+            nxt = get_next_link(doc_results)
+            i += 1
+            time.sleep(1)
     df = pd.DataFrame(responses)
     if extract_text_attachment or components:
         print('extracting text', datetime.datetime.now().strftime('%H:%M:%S'))
@@ -235,24 +387,23 @@ def download_responses(consultation, name=False, dir_responses='../data',
     return df
 
 
-def parse_consultation(url, save_html, dir_html):
+def parse_consultation(url, save_html, dir_html, session=SESSION):
     """Extract metadata"""
-    resp = requests.get(url)
+    resp = session.get(url)
     html = resp.text
     if 'De website is tijdelijk niet beschikbaar' in html:
         return {'url': url}
-    result_soup = bs(html, 'lxml')
-    table = result_soup.find('table', class_='table__data-overview')
-    consultation = parse_table(table)
-    consultation['title'] = result_soup.find('h1').text.strip()
+    doc = lxml.html.fromstring(html)
+    consultation = parse_table(doc)
+    consultation['title'] = doc.find('.//h1').text_content().strip()
     nr = None
-    try:
-        nr_text = result_soup.find('span', class_='reacties__sublabel')
-        nr, _ = nr_text.text.split()
-    except AttributeError:
-        nr_results = re.findall(NR_RESP, html)
-        for nr in nr_results:
-            break
+    sublabel = XP_SUBLABEL(doc)
+    if sublabel:
+        nr, _ = sublabel[0].text_content().split()
+    elif NR_RESP_LABEL in html:
+        match = NR_RESP_RE.search(html)
+        if match:
+            nr = match.group(1)
     consultation['nr_responses'] = nr
     consultation['url'] = url
     if 'mainContentPlaceHolder_consultatierapportDocumentDownloadLink_typeAnchor' in html:
@@ -270,42 +421,51 @@ def parse_consultation(url, save_html, dir_html):
 
 
 def download_consultations(path_consultations='../data/consultations.xlsx',
-                           save_html=False, dir_html='../data/html'):
+                           save_html=False, dir_html='../data/html',
+                           session=SESSION, max_workers=MAX_WORKERS):
     """Download metadata of past consultations
 
     :param path_consultations: path where consultation metadata will be stored
+    :param session: httpx client used to download pages
+    :param max_workers: number of consultations downloaded concurrently
     """
 
     nxt = f'{BASE}/geslotenconsultaties'
+    if not isinstance(path_consultations, PosixPath):
+        path_consultations = Path(path_consultations)
+    path_checkpoint = path_consultations.with_suffix('.jsonl')
     try:
-        df = pd.read_excel(path_consultations)
-        done = list(df.url)
-        consultations = [dict(row) for _, row in df.iterrows()]
+        consultations = load_checkpoint(path_checkpoint, path_consultations)
+        done = {result['url'] for result in consultations}
     except FileNotFoundError:
-        done = []
+        done = set()
         consultations = []
     if save_html and not isinstance(dir_html, PosixPath):
         dir_html = Path(dir_html)
     if save_html:
         dir_html.mkdir(exist_ok=True)
 
+    fetch = partial(
+        parse_consultation, save_html=save_html, dir_html=dir_html,
+        session=session
+    )
     i = 0
-    while nxt:
-        if i % 10 == 0 and consultations:
-            df = pd.DataFrame(consultations)
-            df.to_excel(path_consultations, index=False)
-            print(i, datetime.datetime.now().strftime('%H:%M:%S'))
-        resp = requests.get(nxt)
-        html = resp.text
-        soup = bs(html, 'lxml')
-        result_urls = get_result_urls(soup)
-        consultations.extend([
-            parse_consultation(url, save_html, dir_html) for url in result_urls
-            if url not in done
-        ])
-        nxt = get_next_link(soup)
-        i += 1
-        time.sleep(0.5)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while nxt:
+            if i % 10 == 0 and consultations:
+                print(i, datetime.datetime.now().strftime('%H:%M:%S'))
+            resp = session.get(nxt)
+            html = resp.text
+            doc_results = lxml.html.fromstring(html)
+            result_urls = get_result_urls(doc_results)
+            new_consultations = list(executor.map(
+                fetch, [url for url in result_urls if url not in done]
+            ))
+            save_checkpoint(path_checkpoint, new_consultations)
+            consultations.extend(new_consultations)
+            nxt = get_next_link(doc_results)
+            i += 1
+            time.sleep(0.5)
     df = pd.DataFrame(consultations)
     df.to_excel(path_consultations, index=False)
     return df
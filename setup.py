@@ -16,6 +16,7 @@ setup(name='internetconsultatie',
     license="MIT",
     packages=['internetconsultatie'],
     install_requires=[
-        'requests', 'pandas', 'bs4', 'nltk', 'textract', 'networkx'
+        'httpx[http2]', 'numpy', 'pandas', 'lxml', 'pypdfium2', 'textract',
+        'networkx', 'scipy'
     ],
     zip_safe=False)